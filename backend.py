@@ -9,24 +9,68 @@ import csv
 import queue
 import io
 import traceback
-from datetime import datetime
+import math
+import threading
+import time
+import heapq
+from datetime import datetime, timezone
 from flask import Flask, request, jsonify, g, send_from_directory, Response, make_response
 from flask_cors import CORS
 import logging
 import requests
+import cohere_client
+
+# optional fast encoders; plain json is used when they are not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # basic logging for server-side debugging
 logging.basicConfig(level=logging.INFO)
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DB_PATH = os.path.join(BASE_DIR, "data.db")
+DB_PATH = os.environ.get("WAM_DB_PATH") or os.path.join(BASE_DIR, "data.db")
 ANALYZE_LOG = os.path.join(BASE_DIR, "analyze.log")
 COHERE_API_KEY = os.environ.get("COHERE_API_KEY", "").strip()
+ANALYZE_LLM_BUDGET = float(os.environ.get("ANALYZE_LLM_BUDGET", "4"))  # seconds /api/analyze waits for Cohere
+ANALYZE_LLM_MAX_TOKENS = 400
+METRICS = ("ph", "tds", "turb", "iron")
+
+# alert state tracking (one open alert per site + metric)
+ALERT_HYSTERESIS = 0.05            # fraction of a limit a value must move back inside before resolving
+ALERT_RENOTIFY_SECONDS = 900       # min seconds between re-broadcasts of an ongoing alert
+ALERT_MAX_BROADCASTS_PER_MIN = 30  # global cap on alert SSE events; extra ones are counted, not sent
+
+# spatial queries
+GEO_CLUSTER_CELLS = 8  # cluster grid cells across one map tile at a given zoom
+GEO_BBOX_SCAN_ROWS = 20000  # newest readings scanned for a bbox query before falling back to the R*Tree
+
+# online anomaly detection (per site + metric, updated on every insert)
+ANOMALY_ALPHA = 0.05       # slow EWMA weight (baseline mean/variance)
+ANOMALY_FAST_ALPHA = 0.3   # fast EWMA weight (drift detection)
+ANOMALY_WARMUP = 20        # readings per site/metric before anomalies are raised
+ANOMALY_Z = 4.0            # |z| of a single reading vs baseline -> spike
+ANOMALY_DRIFT_Z = 2.0      # |fast - baseline| / std -> drift
+ANOMALY_RATE_Z = 4.0       # |z| of rate of change vs its own EWMA -> sudden change
 
 app = Flask(__name__, static_folder="public", static_url_path="")
 CORS(app, resources={r"/api/*": {"origins": "*"}, r"/stream": {"origins": "*"}})
 
 clients = []  # SSE client queues
+geo_index = {"rtree": False}  # set by init_db when SQLite has the R*Tree module
+anomaly_state = {}  # (site, metric) -> detector state dict
+anomaly_lock = threading.Lock()
+latest_by_site = {}  # site -> latest reading payload (dashboard first paint)
+latest_lock = threading.Lock()
+open_alerts = {}  # (site, metric) -> open alert dict
+alert_lock = threading.Lock()
+alert_state_lock = threading.Lock()  # serializes check-and-open/update/resolve of open_alerts + alerts rows
+alert_bucket = {"tokens": float(ALERT_MAX_BROADCASTS_PER_MIN), "at": time.monotonic(), "suppressed": 0}
 
 # ---------- DB helpers ----------
 def get_db():
@@ -36,6 +80,14 @@ def get_db():
         db.row_factory = sqlite3.Row
     return db
 
+def ensure_columns(cur, table, columns):
+    # lightweight migration: add any missing columns to an existing table
+    cur.execute(f"PRAGMA table_info({table})")
+    have = {r[1] for r in cur.fetchall()}
+    for name, decl in columns.items():
+        if name not in have:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
 def init_db():
     db = get_db()
     cur = db.cursor()
@@ -52,6 +104,24 @@ def init_db():
             lon REAL
         )
     ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_readings_site_id ON readings(site, id)")
+    try:
+        cur.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS readings_geo
+            USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+        ''')
+        # backfill rows inserted before the index existed (or by an older build)
+        cur.execute('''
+            INSERT INTO readings_geo (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT id, lat, lat, lon, lon FROM readings
+            WHERE lat IS NOT NULL AND lon IS NOT NULL
+              AND id > (SELECT COALESCE(MAX(id), 0) FROM readings_geo)
+        ''')
+        geo_index["rtree"] = True
+    except sqlite3.OperationalError:
+        logging.warning("SQLite R*Tree module unavailable; falling back to a lat/lon index")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_readings_lat_lon ON readings(lat, lon)")
+        geo_index["rtree"] = False
     cur.execute('''
         CREATE TABLE IF NOT EXISTS thresholds (
             id INTEGER PRIMARY KEY CHECK (id = 1),
@@ -66,6 +136,33 @@ def init_db():
             reading_id INTEGER
         )
     ''')
+    ensure_columns(cur, "alerts", {
+        "site": "TEXT",
+        "metric": "TEXT",
+        "state": "TEXT DEFAULT 'resolved'",
+        "count": "INTEGER DEFAULT 1",
+        "first_ts": "TEXT",
+        "last_ts": "TEXT",
+        "last_value": "REAL",
+        "resolved_ts": "TEXT",
+        "bound": "TEXT"
+    })
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_alerts_state ON alerts(state)")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS anomaly_state (
+            site TEXT,
+            metric TEXT,
+            n INTEGER,
+            mean REAL,
+            var REAL,
+            fast REAL,
+            last_value REAL,
+            last_ts TEXT,
+            rate_mean REAL,
+            rate_var REAL,
+            PRIMARY KEY (site, metric)
+        )
+    ''')
     db.commit()
     cur.execute("SELECT COUNT(*) as c FROM thresholds")
     row = cur.fetchone()
@@ -86,29 +183,155 @@ def close_connection(exception):
     if db is not None:
         db.close()
 
+# ---------- serialization ----------
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+COLUMNAR_TYPE = "application/vnd.wam.columnar+json"
+
+def encode_json(obj):
+    # compact JSON as bytes; orjson when available
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, separators=(",", ":"), default=str).encode("utf-8")
+
+def encode_event(event_type, data_bytes):
+    # wrap an already-encoded payload without re-serializing it
+    return b'{"type":' + encode_json(event_type) + b',"data":' + data_bytes + b'}'
+
+def to_columnar(rows, columns=None):
+    # list of dicts -> {"columns": [...], "data": {col: [values...]}}
+    if columns is None:
+        columns = []
+        for r in rows:
+            for k in r:
+                if k not in columns:
+                    columns.append(k)
+    return {"columns": columns, "count": len(rows),
+            "data": {c: [r.get(c) for r in rows] for c in columns}}
+
+def columnar_from_cursor(cur, rows=None):
+    # build the columnar form straight from row tuples, skipping per-row dicts
+    # (pass `rows` if they were already fetched from `cur`)
+    columns = [d[0] for d in cur.description]
+    if rows is None:
+        rows = cur.fetchall()
+    cols = list(zip(*rows)) if rows else [() for _ in columns]
+    return {"columns": columns, "count": len(rows),
+            "data": {c: list(v) for c, v in zip(columns, cols)}}
+
+def columnarize(obj):
+    if isinstance(obj, list) and obj and all(isinstance(r, dict) for r in obj):
+        return to_columnar(obj)
+    if isinstance(obj, dict):
+        return {k: columnarize(v) if isinstance(v, list) else v for k, v in obj.items()}
+    return obj
+
+def wants_msgpack():
+    fmt = request.args.get("format", "")
+    accept = request.headers.get("Accept", "")
+    return fmt == "msgpack" or any(t in accept for t in MSGPACK_TYPES)
+
+def wants_columnar():
+    return request.args.get("format") == "columnar" or COLUMNAR_TYPE in request.headers.get("Accept", "")
+
+def encoded_response(obj, status=200, columnar=None):
+    """
+    Serialize `obj` once according to the request's Accept header / ?format=:
+    msgpack, columnar JSON, or plain JSON. Pass `columnar` to supply a prebuilt
+    columnar form (e.g. from columnar_from_cursor) instead of converting `obj`.
+    """
+    as_columnar = wants_columnar()
+    if as_columnar:
+        obj = columnar if columnar is not None else columnarize(obj)
+    if wants_msgpack():
+        if msgpack is None:
+            return jsonify({"error": "msgpack not available on server"}), 406
+        body, mimetype = msgpack.packb(obj, use_bin_type=True, default=str), "application/msgpack"
+    else:
+        body, mimetype = encode_json(obj), (COLUMNAR_TYPE if as_columnar else "application/json")
+    resp = Response(body, status=status, mimetype=mimetype)
+    resp.headers["Vary"] = "Accept"
+    return resp
+
 # ---------- utils ----------
 def broadcast_event(obj):
-    text = json.dumps(obj)
+    broadcast_encoded(encode_json(obj))
+
+def broadcast_encoded(body):
+    # one SSE frame shared by every subscriber queue
+    frame = b"data: " + body + b"\n\n"
     for q in list(clients):
         try:
-            q.put(text, timeout=0.1)
+            q.put(frame, timeout=0.1)
         except Exception:
             try:
                 clients.remove(q)
             except Exception:
                 pass
 
-def create_alert(msg, reading_id=None):
+def alert_broadcast_allowed():
+    # token bucket shared by all alert events; refills at ALERT_MAX_BROADCASTS_PER_MIN
+    now = time.monotonic()
+    rate = ALERT_MAX_BROADCASTS_PER_MIN / 60.0
+    b = alert_bucket
+    b["tokens"] = min(float(ALERT_MAX_BROADCASTS_PER_MIN), b["tokens"] + (now - b["at"]) * rate)
+    b["at"] = now
+    if b["tokens"] >= 1:
+        b["tokens"] -= 1
+        return True
+    b["suppressed"] += 1
+    return False
+
+def notify_alert(event_type, alert_obj, limited=True):
+    # state changes (open/resolve) pass limited=False: they always go out and never spend tokens
+    with alert_lock:
+        if limited and not alert_broadcast_allowed():
+            return False
+        suppressed, alert_bucket["suppressed"] = alert_bucket["suppressed"], 0
+    data = dict(alert_obj)
+    if suppressed:
+        data["suppressed"] = suppressed
+    broadcast_event({"type": event_type, "data": data})
+    return True
+
+def create_alert(msg, reading_id=None, site=None, metric=None, value=None, commit=True, notify=True, bound=None):
     db = get_db()
     cur = db.cursor()
     ts = datetime.utcnow().isoformat() + "Z"
-    cur.execute("INSERT INTO alerts (ts, message, reading_id) VALUES (?, ?, ?)", (ts, msg, reading_id))
-    db.commit()
+    cur.execute('''
+        INSERT INTO alerts (ts, message, reading_id, site, metric, state, count, first_ts, last_ts, last_value, bound)
+        VALUES (?, ?, ?, ?, ?, 'open', 1, ?, ?, ?, ?)
+    ''', (ts, msg, reading_id, site, metric, ts, ts, value, bound))
+    if commit:
+        db.commit()
     aid = cur.lastrowid
-    alert_obj = {"id": aid, "ts": ts, "message": msg, "reading_id": reading_id}
-    broadcast_event({"type": "alert", "data": alert_obj})
+    alert_obj = {"id": aid, "ts": ts, "message": msg, "reading_id": reading_id, "site": site,
+                 "metric": metric, "state": "open", "count": 1, "first_ts": ts, "last_ts": ts,
+                 "last_value": value, "bound": bound}
+    if site is not None and metric is not None:
+        with alert_lock:
+            open_alerts[(site, metric)] = dict(alert_obj, notified_at=time.monotonic())
+    if notify:
+        notify_alert("alert", alert_obj, limited=False)
     return aid
 
+def load_open_alerts():
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        SELECT * FROM alerts
+        WHERE state IN ('open', 'ongoing') AND site IS NOT NULL AND metric IS NOT NULL
+    ''')
+    loaded = {}
+    for r in cur.fetchall():
+        a = dict(r)
+        # don't re-notify immediately after a restart
+        a["notified_at"] = time.monotonic()
+        loaded[(a["site"], a["metric"])] = a
+    with alert_lock:
+        open_alerts.clear()
+        open_alerts.update(loaded)
+    return len(loaded)
+
 def get_thresholds():
     db = get_db()
     cur = db.cursor()
@@ -123,41 +346,273 @@ def set_thresholds(obj):
     db.commit()
     broadcast_event({"type":"thresholds","data":obj})
 
+def metric_status(metric, value, th, bound=None):
+    """
+    Classify one value against the thresholds.
+    Returns (status, reason, breached): status is "breach", "band" (inside the limits
+    but within the hysteresis band of `bound`, the limit an open alert was raised
+    for, so it stays open) or "clear"; `breached` names the violated limit
+    (e.g. "ph_min") on a breach, else None.
+    """
+    if metric == "ph":
+        lo, hi = th.get("ph_min"), th.get("ph_max")
+        if lo is not None and value < lo:
+            return "breach", f"pH low ({value} < {lo})", "ph_min"
+        if hi is not None and value > hi:
+            return "breach", f"pH high ({value} > {hi})", "ph_max"
+        # alerts from before bounds were recorded (bound None) keep the two-sided band
+        if (bound in ("ph_min", None) and lo is not None and value < lo + abs(lo) * ALERT_HYSTERESIS) or \
+           (bound in ("ph_max", None) and hi is not None and value > hi - abs(hi) * ALERT_HYSTERESIS):
+            return "band", None, None
+        return "clear", None, None
+    labels = {"tds": "TDS", "turb": "Turbidity", "iron": "Iron"}
+    hi = th.get(f"{metric}_max")
+    if hi is None:
+        return "clear", None, None
+    if value > hi:
+        return "breach", f"{labels.get(metric, metric)} high ({value} > {hi})", f"{metric}_max"
+    if value > hi - abs(hi) * ALERT_HYSTERESIS:
+        return "band", None, None
+    return "clear", None, None
+
+def evaluate_breaches(row, th):
+    # list of (metric, reason) for every metric in `row` that is over its threshold
+    out = []
+    for m in METRICS:
+        try:
+            if row.get(m) is None:
+                continue
+            status, reason, _ = metric_status(m, float(row.get(m)), th)
+        except Exception:
+            continue
+        if status == "breach":
+            out.append((m, reason))
+    return out
+
+def resolve_alert(cur, site, metric, current):
+    # mark an open alert resolved (caller commits); returns the event payload
+    now_ts = datetime.utcnow().isoformat() + "Z"
+    with alert_lock:
+        open_alerts.pop((site, metric), None)
+    cur.execute("UPDATE alerts SET state = 'resolved', resolved_ts = ? WHERE id = ?",
+                (now_ts, current["id"]))
+    resolved = {k: v for k, v in current.items() if k != "notified_at"}
+    resolved.update({"state": "resolved", "resolved_ts": now_ts})
+    return resolved
+
 def check_and_create_alerts_for_row(reading_id, row):
+    """
+    Track alert state per (site, metric): the first breach opens an alert ('open'),
+    further breaches only bump its counters ('ongoing', re-broadcast at most every
+    ALERT_RENOTIFY_SECONDS), and the alert resolves once the value is back outside
+    the hysteresis band of the limit it was raised for ('resolved'). Jumping straight
+    to the opposite limit (pH low -> high) resolves the old alert and opens a new one.
+    """
     th = get_thresholds()
-    reasons = []
-    try:
-        if row.get("ph") is not None:
-            ph = float(row.get("ph"))
-            if "ph_min" in th and ph < th["ph_min"]:
-                reasons.append(f"pH low ({ph} < {th['ph_min']})")
-            if "ph_max" in th and ph > th["ph_max"]:
-                reasons.append(f"pH high ({ph} > {th['ph_max']})")
-    except Exception:
-        pass
-    try:
-        if row.get("tds") is not None and "tds_max" in th:
-            tds = float(row.get("tds"))
-            if tds > th["tds_max"]:
-                reasons.append(f"TDS high ({tds} > {th['tds_max']})")
-    except Exception:
-        pass
-    try:
-        if row.get("turb") is not None and "turb_max" in th:
-            turb = float(row.get("turb"))
-            if turb > th["turb_max"]:
-                reasons.append(f"Turbidity high ({turb} > {th['turb_max']})")
-    except Exception:
-        pass
+    site = row.get("site") or "unknown"
+    db = get_db()
+    cur = db.cursor()
+    events = []  # (event_type, data, limited), sent after commit
+    # lookup and open/update/resolve must be one step, or concurrent readings can open duplicates
+    with alert_state_lock:
+        dirty = False
+        for m in METRICS:
+            try:
+                if row.get(m) is None:
+                    continue
+                value = float(row.get(m))
+            except Exception:
+                continue
+            with alert_lock:
+                current = open_alerts.get((site, m))
+            bound = current.get("bound") if current is not None else None
+            status, reason, breached = metric_status(m, value, th, bound)
+            if status == "breach" and current is not None and bound not in (None, breached):
+                events.append(("alert_resolved", resolve_alert(cur, site, m, current), False))
+                current = None
+            if status == "breach" and current is None:
+                create_alert(reason, reading_id=reading_id, site=site, metric=m, value=value,
+                             commit=False, notify=False, bound=breached)
+                with alert_lock:
+                    opened = {k: v for k, v in open_alerts[(site, m)].items() if k != "notified_at"}
+                events.append(("alert", opened, False))
+                dirty = True
+            elif status == "breach":
+                now_ts = datetime.utcnow().isoformat() + "Z"
+                with alert_lock:
+                    current.update({"count": current["count"] + 1, "last_ts": now_ts, "last_value": value,
+                                    "message": reason, "reading_id": reading_id, "state": "ongoing"})
+                    renotify = time.monotonic() - current["notified_at"] >= ALERT_RENOTIFY_SECONDS
+                    if renotify:
+                        current["notified_at"] = time.monotonic()
+                    snapshot = {k: v for k, v in current.items() if k != "notified_at"}
+                cur.execute('''
+                    UPDATE alerts SET state = 'ongoing', count = ?, last_ts = ?, last_value = ?, message = ?,
+                        reading_id = ?
+                    WHERE id = ?
+                ''', (snapshot["count"], now_ts, value, reason, reading_id, snapshot["id"]))
+                dirty = True
+                if renotify:
+                    events.append(("alert", snapshot, True))
+            elif status == "clear" and current is not None:
+                events.append(("alert_resolved", resolve_alert(cur, site, m, current), False))
+                dirty = True
+        if dirty:
+            db.commit()
+    for event_type, data, limited in events:
+        notify_alert(event_type, data, limited=limited)
+
+# ---------- latest reading per site ----------
+def load_latest_snapshot():
+    # one indexed lookup per site via idx_readings_site_id
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        SELECT r.* FROM readings r
+        JOIN (SELECT site, MAX(id) AS id FROM readings GROUP BY site) m ON r.id = m.id
+    ''')
+    loaded = {}
+    for r in cur.fetchall():
+        d = dict(r)
+        key = d.get("site") or "unknown"
+        if key not in loaded or loaded[key]["id"] < d["id"]:
+            loaded[key] = d
+    with latest_lock:
+        latest_by_site.clear()
+        latest_by_site.update(loaded)
+    return len(loaded)
+
+def update_latest_snapshot(payload):
+    key = payload.get("site") or "unknown"
+    with latest_lock:
+        cur = latest_by_site.get(key)
+        if cur is None or cur["id"] < payload["id"]:
+            latest_by_site[key] = payload
+
+# ---------- online anomaly detection ----------
+def parse_ts(ts):
+    # naive UTC datetime; offset timestamps are converted so they compare with "Z" ones
     try:
-        if row.get("iron") is not None and "iron_max" in th:
-            iron = float(row.get("iron"))
-            if iron > th["iron_max"]:
-                reasons.append(f"Iron high ({iron} > {th['iron_max']})")
+        dt = datetime.fromisoformat(str(ts).rstrip("Z"))
     except Exception:
-        pass
-    if reasons:
-        create_alert("; ".join(reasons), reading_id=reading_id)
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+def new_anomaly_state():
+    return {"n": 0, "mean": None, "var": 0.0, "fast": None, "last_value": None,
+            "last_ts": None, "rate_mean": None, "rate_var": 0.0}
+
+def update_anomaly_state(st, value, ts):
+    """
+    Fold one reading into the O(1) detector state `st` (mutated in place).
+    Returns a list of (kind, score) tuples: kind is "spike", "drift" or "rate".
+    """
+    found = []
+    if st["n"] == 0 or st["mean"] is None:
+        st.update({"n": 1, "mean": value, "var": 0.0, "fast": value,
+                   "last_value": value, "last_ts": ts})
+        return found
+
+    mean, var, fast = st["mean"], st["var"], st["fast"]
+    std = math.sqrt(var) if var > 0 else 0.0
+    new_fast = fast + ANOMALY_FAST_ALPHA * (value - fast)
+    warm = st["n"] >= ANOMALY_WARMUP
+
+    if warm and std > 0:
+        z = (value - mean) / std
+        if abs(z) > ANOMALY_Z:
+            found.append(("spike", z))
+        else:
+            # drift: fast EWMA pulls away from the slow baseline; only report the crossing
+            d_old = (fast - mean) / std
+            d_new = (new_fast - mean) / std
+            if abs(d_new) > ANOMALY_DRIFT_Z and abs(d_old) <= ANOMALY_DRIFT_Z:
+                found.append(("drift", d_new))
+
+    # rate of change per minute, scored against its own EWMA
+    t_prev, t_cur = parse_ts(st["last_ts"]), parse_ts(ts)
+    if t_prev is not None and t_cur is not None and st["last_value"] is not None:
+        dt = (t_cur - t_prev).total_seconds() / 60.0
+        if dt > 0:
+            rate = (value - st["last_value"]) / dt
+            if st["rate_mean"] is None:
+                st["rate_mean"], st["rate_var"] = rate, 0.0
+            else:
+                r_std = math.sqrt(st["rate_var"]) if st["rate_var"] > 0 else 0.0
+                if warm and r_std > 0:
+                    rz = (rate - st["rate_mean"]) / r_std
+                    if abs(rz) > ANOMALY_RATE_Z:
+                        found.append(("rate", rz))
+                diff = rate - st["rate_mean"]
+                incr = ANOMALY_ALPHA * diff
+                st["rate_mean"] += incr
+                st["rate_var"] = (1 - ANOMALY_ALPHA) * (st["rate_var"] + diff * incr)
+
+    diff = value - mean
+    incr = ANOMALY_ALPHA * diff
+    st["mean"] = mean + incr
+    st["var"] = (1 - ANOMALY_ALPHA) * (var + diff * incr)
+    st["fast"] = new_fast
+    st["last_value"] = value
+    st["last_ts"] = ts
+    st["n"] += 1
+    return found
+
+def load_anomaly_state():
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("SELECT * FROM anomaly_state")
+    loaded = {}
+    for r in cur.fetchall():
+        st = dict(r)
+        loaded[(st.pop("site"), st.pop("metric"))] = st
+    with anomaly_lock:
+        anomaly_state.clear()
+        anomaly_state.update(loaded)
+    return len(loaded)
+
+def check_anomalies_for_row(reading_id, row):
+    """
+    Update detector state for one reading and stage the anomaly_state upsert on the
+    current connection; the caller commits it with the reading. Returns the anomaly
+    events, which the caller broadcasts after committing.
+    """
+    site = row.get("site") or "unknown"
+    ts = row.get("ts")
+    events = []
+    updates = []
+    with anomaly_lock:
+        for m in METRICS:
+            try:
+                if row.get(m) is None:
+                    continue
+                value = float(row.get(m))
+            except Exception:
+                continue
+            st = anomaly_state.setdefault((site, m), new_anomaly_state())
+            mean_before, var_before = st["mean"], st["var"]
+            for kind, score in update_anomaly_state(st, value, ts):
+                events.append({
+                    "reading_id": reading_id, "site": site, "metric": m, "kind": kind,
+                    "score": round(score, 3), "value": value, "mean": mean_before,
+                    "std": math.sqrt(var_before) if var_before > 0 else 0.0, "ts": ts
+                })
+            updates.append((site, m, st["n"], st["mean"], st["var"], st["fast"], st["last_value"],
+                            st["last_ts"], st["rate_mean"], st["rate_var"]))
+    if updates:
+        db = get_db()
+        cur = db.cursor()
+        cur.executemany('''
+            INSERT INTO anomaly_state (site, metric, n, mean, var, fast, last_value, last_ts, rate_mean, rate_var)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(site, metric) DO UPDATE SET
+                n=excluded.n, mean=excluded.mean, var=excluded.var, fast=excluded.fast,
+                last_value=excluded.last_value, last_ts=excluded.last_ts,
+                rate_mean=excluded.rate_mean, rate_var=excluded.rate_var
+        ''', updates)
+    return events
 
 def insert_row(row):
     db = get_db()
@@ -167,8 +622,14 @@ def insert_row(row):
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ''', (row.get("ts"), row.get("ph"), row.get("tds"), row.get("turb"),
           row.get("iron"), row.get("site"), row.get("lat"), row.get("lon")))
-    db.commit()
     rid = cur.lastrowid
+    if geo_index["rtree"]:
+        try:
+            lat, lon = float(row.get("lat")), float(row.get("lon"))
+            cur.execute("INSERT INTO readings_geo (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+                        (rid, lat, lat, lon, lon))
+        except (TypeError, ValueError):
+            pass
     payload = {
         "id": rid,
         "ts": row.get("ts"),
@@ -180,8 +641,18 @@ def insert_row(row):
         "lat": row.get("lat"),
         "lon": row.get("lon")
     }
-    broadcast_event({"type": "reading", "data": payload})
+    # detector state is written in the reading's transaction (one commit per reading)
+    try:
+        anomalies = check_anomalies_for_row(rid, payload)
+    except Exception:
+        app.logger.exception("Anomaly detection failed for reading %s", rid)
+        anomalies = []
+    db.commit()
+    update_latest_snapshot(payload)
+    broadcast_encoded(encode_event("reading", encode_json(payload)))
     check_and_create_alerts_for_row(rid, payload)
+    for ev in anomalies:
+        broadcast_event({"type": "anomaly", "data": ev})
     return rid
 
 # ---------- routes ----------
@@ -242,8 +713,144 @@ def api_readings():
     db = get_db()
     cur = db.cursor()
     cur.execute("SELECT * FROM readings ORDER BY id DESC LIMIT ?", (limit,))
+    if wants_columnar():
+        return encoded_response(None, columnar=columnar_from_cursor(cur))
     rows = [dict(r) for r in cur.fetchall()]
-    return jsonify(rows)
+    return encoded_response(rows)
+
+@app.route("/api/sites/latest", methods=["GET"])
+def api_sites_latest():
+    th = get_thresholds()
+    with latest_lock:
+        snapshot = sorted(latest_by_site.items())
+    with alert_lock:
+        open_keys = list(open_alerts.keys())
+    open_by_site = {}
+    for site, metric in open_keys:
+        open_by_site.setdefault(site, []).append(metric)
+    out = []
+    for site, reading in snapshot:
+        breaches = [{"metric": m, "reason": reason} for m, reason in evaluate_breaches(reading, th)]
+        out.append({
+            "site": site,
+            "reading": reading,
+            "status": "breach" if breaches else "ok",
+            "breaches": breaches,
+            "open_alerts": sorted(open_by_site.get(site, []))
+        })
+    return encoded_response(out)
+
+# ---------- spatial queries ----------
+def parse_bbox(args, required=True):
+    keys = ("min_lat", "min_lon", "max_lat", "max_lon")
+    if not required and not any(k in args for k in keys):
+        return (-90.0, -180.0, 90.0, 180.0)
+    min_lat, min_lon, max_lat, max_lon = (float(args[k]) for k in keys)
+    if min_lat > max_lat or min_lon > max_lon:
+        raise ValueError("min must not exceed max")
+    return (min_lat, min_lon, max_lat, max_lon)
+
+def bbox_subquery(bbox):
+    # SQL selecting readings (id, lat, lon, ...) inside bbox, via the R*Tree when available
+    min_lat, min_lon, max_lat, max_lon = bbox
+    if geo_index["rtree"]:
+        # R*Tree boxes are float32 rounded outward: use an overlap test on the index,
+        # then apply the exact bounds to the stored lat/lon
+        return ('''SELECT r.* FROM readings_geo g JOIN readings r ON r.id = g.id
+                   WHERE g.max_lat >= ? AND g.min_lat <= ? AND g.max_lon >= ? AND g.min_lon <= ?
+                     AND r.lat BETWEEN ? AND ? AND r.lon BETWEEN ? AND ?''',
+                (min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon))
+    return ('''SELECT * FROM readings
+               WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?''',
+            (min_lat, max_lat, min_lon, max_lon))
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 6371.0 * 2 * math.asin(min(1.0, math.sqrt(a)))
+
+@app.route("/api/geo/bbox", methods=["GET"])
+def api_geo_bbox():
+    try:
+        bbox = parse_bbox(request.args)
+    except (KeyError, ValueError):
+        return jsonify({"error": "min_lat, min_lon, max_lat, max_lon required"}), 400
+    limit = int(request.args.get("limit", 500))
+    db = get_db()
+    cur = db.cursor()
+    # a wide viewport matches most rows: walk the newest readings by id and stop at
+    # `limit` instead of sorting every index hit. If the recent window doesn't fill
+    # the page the bbox is selective, so the R*Tree hits are few and cheap to sort.
+    min_lat, min_lon, max_lat, max_lon = bbox
+    scan = max(GEO_BBOX_SCAN_ROWS, limit * 10)
+    cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM readings")
+    floor_id = cur.fetchone()["id"] - scan
+    # unary + keeps SQLite on the rowid range instead of a lat/lon index
+    cur.execute('''
+        SELECT * FROM readings
+        WHERE id > ? AND +lat BETWEEN ? AND ? AND +lon BETWEEN ? AND ?
+        ORDER BY id DESC LIMIT ?
+    ''', (floor_id, min_lat, max_lat, min_lon, max_lon, limit))
+    rows = cur.fetchall()
+    if len(rows) < limit and floor_id > 0:
+        sql, params = bbox_subquery(bbox)
+        cur.execute(f"SELECT * FROM ({sql}) ORDER BY id DESC LIMIT ?", params + (limit,))
+        rows = cur.fetchall()
+    if wants_columnar():
+        return encoded_response(None, columnar=columnar_from_cursor(cur, rows))
+    return encoded_response([dict(r) for r in rows])
+
+@app.route("/api/geo/nearest", methods=["GET"])
+def api_geo_nearest():
+    # k nearest sites, using each site's latest known position
+    try:
+        lat = float(request.args["lat"])
+        lon = float(request.args["lon"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lon required"}), 400
+    k = int(request.args.get("k", 5))
+    with latest_lock:
+        snapshot = list(latest_by_site.items())
+    candidates = []
+    for site, reading in snapshot:
+        try:
+            d = haversine_km(lat, lon, float(reading["lat"]), float(reading["lon"]))
+        except (TypeError, ValueError):
+            continue
+        candidates.append((d, site, reading))
+    nearest = heapq.nsmallest(k, candidates, key=lambda c: c[0])
+    return encoded_response([{"site": site, "distance_km": round(d, 3), "reading": reading} for d, site, reading in nearest])
+
+@app.route("/api/geo/clusters", methods=["GET"])
+def api_geo_clusters():
+    # grid clustering of sites (at their latest position) from the in-memory snapshot:
+    # one marker per occupied cell, cost follows the number of sites, not readings
+    try:
+        min_lat, min_lon, max_lat, max_lon = parse_bbox(request.args, required=False)
+        zoom = max(0, min(22, int(request.args.get("zoom", 3))))
+    except (KeyError, ValueError):
+        return jsonify({"error": "invalid bbox or zoom"}), 400
+    cell = 360.0 / (2 ** zoom) / GEO_CLUSTER_CELLS
+    with latest_lock:
+        snapshot = list(latest_by_site.values())
+    cells = {}
+    for reading in snapshot:
+        try:
+            lat, lon = float(reading["lat"]), float(reading["lon"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            continue
+        key = (int((lat + 90.0) // cell), int((lon + 180.0) // cell))
+        c = cells.setdefault(key, {"lat": 0.0, "lon": 0.0, "count": 0, "latest_id": 0})
+        c["lat"] += lat
+        c["lon"] += lon
+        c["count"] += 1
+        c["latest_id"] = max(c["latest_id"], reading["id"])
+    clusters = [{"lat": c["lat"] / c["count"], "lon": c["lon"] / c["count"], "count": c["count"],
+                 "sites": c["count"], "latest_id": c["latest_id"]} for c in cells.values()]
+    return encoded_response({"zoom": zoom, "cell_deg": cell, "clusters": clusters})
 
 @app.route("/api/thresholds", methods=["GET", "POST"])
 def api_thresholds():
@@ -263,11 +870,17 @@ def api_thresholds():
 @app.route("/api/alerts", methods=["GET"])
 def api_alerts():
     limit = int(request.args.get("limit", 200))
+    state = request.args.get("state")
     db = get_db()
     cur = db.cursor()
-    cur.execute("SELECT * FROM alerts ORDER BY id DESC LIMIT ?", (limit,))
+    if state:
+        cur.execute("SELECT * FROM alerts WHERE state = ? ORDER BY id DESC LIMIT ?", (state, limit))
+    else:
+        cur.execute("SELECT * FROM alerts ORDER BY id DESC LIMIT ?", (limit,))
+    if wants_columnar():
+        return encoded_response(None, columnar=columnar_from_cursor(cur))
     rows = [dict(r) for r in cur.fetchall()]
-    return jsonify(rows)
+    return encoded_response(rows)
 
 @app.route("/api/report", methods=["GET"])
 def api_report():
@@ -344,11 +957,11 @@ def stream():
             while True:
                 try:
                     # wait for an event up to 15s
-                    data = q.get(timeout=15)
-                    yield f"data: {data}\n\n"
+                    # frames are pre-encoded once in broadcast_encoded
+                    yield q.get(timeout=15)
                 except queue.Empty:
                     # SSE keepalive comment prevents some proxies from closing the connection
-                    yield ": keepalive\n\n"
+                    yield b": keepalive\n\n"
         except GeneratorExit:
             pass
     q = queue.Queue()
@@ -456,6 +1069,33 @@ def local_analysis(rows_list):
 
     return {"type":"local", "generated_text":"\n".join(lines), "stats": stats, "breaches": breaches, "charts": charts}
 
+def enrich_with_llm(resp_json, payload):
+    """
+    Optional Cohere pass over the local analysis, bounded by ANALYZE_LLM_BUDGET.
+    On any failure or timeout the local text is kept. The same deadline caps the
+    HTTP timeout, so a timed-out call is abandoned, not finished in the background.
+    """
+    started = time.monotonic()
+    instructions = payload.get("inputs") if isinstance(payload.get("inputs"), str) else ""
+    if not instructions:
+        instructions = ("You are a water-quality analyst. Summarize the findings below, call out potential "
+                        "concerns, and suggest monitoring or mitigation actions in a concise bulleted list.")
+    prompt = f"{instructions}\n\nLocal statistical analysis:\n{resp_json['generated_text']}"
+    try:
+        future = cohere_client.get_client().submit(prompt, max_tokens=ANALYZE_LLM_MAX_TOKENS,
+                                                   deadline=started + ANALYZE_LLM_BUDGET)
+        result = future.result(timeout=ANALYZE_LLM_BUDGET)
+    except Exception as e:
+        app.logger.warning("Cohere enrichment skipped: %r", e)
+        return {"used": False, "reason": type(e).__name__, "latency_ms": int((time.monotonic() - started) * 1000)}
+    if not result.get("text"):
+        return {"used": False, "reason": "empty response"}
+    resp_json["local_text"] = resp_json["generated_text"]
+    resp_json["generated_text"] = result["text"]
+    resp_json["type"] = "cohere"
+    return {"used": True, "cached": result.get("cached", False),
+            "latency_ms": int((time.monotonic() - started) * 1000)}
+
 @app.route("/api/analyze", methods=["POST"])
 def api_analyze():
     try:
@@ -505,6 +1145,10 @@ def api_analyze():
         except Exception:
             resp_json["generated_text"] = "Local analysis completed."
 
+    # Optional LLM enrichment (pass "enrich": false to skip)
+    if payload.get("enrich", True) and cohere_client.is_configured():
+        resp_json["llm"] = enrich_with_llm(resp_json, payload)
+
     # Log response
     try:
         with open(ANALYZE_LOG, "a") as fh:
@@ -514,7 +1158,7 @@ def api_analyze():
     except Exception:
         app.logger.exception("Failed to write analyze response to log")
 
-    return jsonify(resp_json)
+    return encoded_response(resp_json)
 
 
 # static serving
@@ -534,6 +1178,9 @@ def serve(path):
 # initialize DB
 with app.app_context():
     init_db()
+    load_latest_snapshot()
+    load_open_alerts()
+    load_anomaly_state()
 
 if __name__ == "__main__":
     print("Starting backend on http://0.0.0.0:5001")
@@ -0,0 +1,60 @@
+# bench_tracker.py -- per-frame CentroidTracker cost as the number of tracks grows
+# Usage: python bench_tracker.py [frames_per_size]
+import sys, time
+import numpy as np
+
+from count_vehicles import CentroidTracker, linear_sum_assignment
+
+SIZES = [10, 25, 50, 100, 200, 400]
+FRAMES = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+W, H = 1920, 1080
+BOX = 40
+
+def legacy_distance(objectCentroids, inputCentroids):
+    # the original per-pair loop, kept here as the baseline
+    D = np.zeros((len(objectCentroids), len(inputCentroids)), dtype="float")
+    for i, oc in enumerate(objectCentroids):
+        for j, nc in enumerate(inputCentroids):
+            D[i, j] = np.linalg.norm(np.array(oc) - np.array(nc))
+    return D
+
+def synthetic_frames(n, frames, rng):
+    # n objects drifting a few pixels per frame, detections shuffled, ~5% missed
+    pos = rng.uniform([0, 0], [W, H], size=(n, 2))
+    vel = rng.normal(0, 3, size=(n, 2))
+    out = []
+    for _ in range(frames):
+        pos = pos + vel + rng.normal(0, 1, size=(n, 2))
+        keep = rng.random(n) > 0.05
+        p = pos[keep][rng.permutation(int(keep.sum()))]
+        rects = [(int(x - BOX), int(y - BOX), int(x + BOX), int(y + BOX)) for x, y in p]
+        out.append(rects)
+    return out
+
+def time_tracker(frames, matching):
+    tracker = CentroidTracker(maxDisappeared=40, maxDistance=60, matching=matching)
+    tracker.update(frames[0], ["car"] * len(frames[0]))
+    t0 = time.perf_counter()
+    for rects in frames[1:]:
+        tracker.update(rects, ["car"] * len(rects))
+    return (time.perf_counter() - t0) * 1000.0 / (len(frames) - 1)
+
+def time_legacy_distance(frames):
+    t0 = time.perf_counter()
+    for prev, cur in zip(frames, frames[1:]):
+        oc = [((a + c) // 2, (b + d) // 2) for a, b, c, d in prev]
+        nc = [((a + c) // 2, (b + d) // 2) for a, b, c, d in cur]
+        legacy_distance(oc, nc)
+    return (time.perf_counter() - t0) * 1000.0 / (len(frames) - 1)
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    modes = ["greedy"] + (["hungarian"] if linear_sum_assignment is not None else [])
+    print(f"{FRAMES} frames per size, ms per frame")
+    print(f"{'tracks':>7} {'legacy D only':>14} " + " ".join(f"{m:>10}" for m in modes))
+    for n in SIZES:
+        frames = synthetic_frames(n, FRAMES, rng)
+        # the quadratic Python loop gets slow quickly; sample fewer frames for it
+        legacy = time_legacy_distance(frames[:max(3, FRAMES // max(1, n // 10))])
+        times = [time_tracker(frames, m) for m in modes]
+        print(f"{n:>7} {legacy:>14.2f} " + " ".join(f"{t:>10.2f}" for t in times))
@@ -1,14 +1,278 @@
 # cohere_client.py
-# Simple Cohere REST helper using requests.
+# Cohere REST client: pooled keep-alive session, bounded concurrency, retries with
+# backoff, a circuit breaker and an LRU (+ optional disk) response cache.
 import os
-import requests
+import json
+import time
+import random
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
 
 COHERE_KEY = os.environ.get("COHERE_API_KEY", "").strip()
-COHERE_URL = "https://api.cohere.com/v1/generate"  # Cohere generation endpoint
+# Cohere generation endpoint; override (e.g. with a local stub server) via COHERE_URL
+COHERE_URL = os.environ.get("COHERE_URL", "https://api.cohere.com/v1/generate").strip()
+COHERE_MODEL = os.environ.get("COHERE_MODEL", "command").strip()
+COHERE_CACHE_DIR = os.environ.get("COHERE_CACHE_DIR", "").strip()  # empty -> memory cache only
+
+REQUEST_TIMEOUT = 30      # seconds per HTTP attempt
+MAX_CONCURRENCY = 4       # worker threads / pooled connections
+MAX_RETRIES = 3           # retries after the first attempt (429, 5xx, connection errors, timeouts)
+BACKOFF_BASE = 0.5        # seconds; doubles per retry, with jitter
+BACKOFF_MAX = 8.0         # longest retry sleep; a larger Retry-After fails the call instead
+BREAKER_FAILURES = 5      # consecutive failed calls before the circuit opens
+BREAKER_COOLDOWN = 30.0   # seconds the circuit stays open before a trial call
+CACHE_SIZE = 256          # in-memory LRU entries
 
 logger = logging.getLogger("cohere_client")
 
+class CircuitOpenError(RuntimeError):
+    """Raised without touching the network while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """closed -> (N consecutive failures) -> open -> (cooldown) -> half-open -> one trial call."""
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def release(self):
+        # the allowed call never reached the service (e.g. its deadline expired in the
+        # queue): free the half-open trial slot without recording an outcome
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+def parse_generation(j):
+    # Cohere returns generated text under choices[0].text or `generations` depending on model/version
+    if "generations" in j and isinstance(j["generations"], list) and j["generations"]:
+        return j["generations"][0].get("text") or j["generations"][0].get("content")
+    if "choices" in j and isinstance(j["choices"], list) and j["choices"]:
+        return j["choices"][0].get("text")
+    if "text" in j:
+        return j["text"]
+    # fallback: stringify entire body
+    return str(j)
+
+class CohereClient:
+    def __init__(self, api_key=None, url=None, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES,
+                 max_concurrency=MAX_CONCURRENCY, cache_size=CACHE_SIZE, cache_dir=None, breaker=None):
+        self.api_key = COHERE_KEY if api_key is None else api_key
+        self.url = url or COHERE_URL
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.cache_size = cache_size
+        self.cache_dir = COHERE_CACHE_DIR if cache_dir is None else cache_dir
+        self.breaker = breaker or CircuitBreaker()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="cohere")
+        # keep-alive pool sized to the worker count; retries are handled here, not by urllib3
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        })
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    # ---------- cache ----------
+    @staticmethod
+    def cache_key(prompt, model, max_tokens, temperature):
+        raw = json.dumps([model, max_tokens, temperature, prompt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, key + ".json")
+            try:
+                with open(path) as fh:
+                    value = json.load(fh)
+            except (OSError, ValueError):
+                return None
+            self._cache_put(key, value, disk=False)
+            return value
+        return None
+
+    def _cache_put(self, key, value, disk=True):
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        if disk and self.cache_dir:
+            path = os.path.join(self.cache_dir, key + ".json")
+            try:
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "w") as fh:
+                    json.dump(value, fh)
+                os.replace(tmp, path)
+            except OSError:
+                logger.warning("Could not write cache entry %s", path)
+
+    # ---------- requests ----------
+    def generate(self, prompt, model=None, max_tokens=256, temperature=0.0, deadline=None):
+        """
+        Send `prompt` to Cohere and return { 'success': True, 'text': '...', 'raw': {...}, 'cached': bool }.
+        `deadline` (time.monotonic() value) caps the total time spent across retries.
+        Raises CircuitOpenError, requests.HTTPError or requests.RequestException.
+        """
+        if not self.api_key:
+            raise RuntimeError("COHERE_API_KEY not set")
+        model = model or COHERE_MODEL
+        key = self.cache_key(prompt, model, max_tokens, temperature)
+        hit = self._cache_get(key)
+        if hit is not None:
+            return dict(hit, cached=True)
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("Cohere circuit open; skipping request")
+
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+        attempt = 0
+        while True:
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    self._budget_exhausted(attempt)
+                    raise requests.Timeout("Cohere latency budget exhausted")
+            retry_after = None
+            try:
+                r = self.session.post(self.url, json=payload, timeout=timeout)
+            except requests.Timeout as e:
+                if timeout < self.timeout:
+                    # cut short by the caller's deadline, not by our own request timeout
+                    self._budget_exhausted(attempt)
+                    raise
+                error = e
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+            except requests.RequestException:
+                # not retryable (bad URL, invalid headers, ...); still settle the breaker
+                self.breaker.record_failure()
+                raise
+            else:
+                if r.status_code < 400:
+                    try:
+                        j = r.json()
+                    except ValueError:
+                        self.breaker.record_failure()
+                        raise
+                    break
+                if r.status_code != 429 and r.status_code < 500:
+                    # the request itself is wrong: retrying won't help and the service is up
+                    self.breaker.record_success()
+                    r.raise_for_status()
+                retry_after = r.headers.get("Retry-After")
+                error = requests.HTTPError(f"{r.status_code} from Cohere", response=r)
+
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)) * (0.5 + random.random() / 2)
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+            # a Retry-After beyond BACKOFF_MAX would park a pool worker for that long: give up instead
+            if attempt >= self.max_retries or delay > BACKOFF_MAX or \
+               (deadline is not None and time.monotonic() + delay >= deadline):
+                self.breaker.record_failure()
+                raise error
+            logger.info("Cohere request failed (%s); retry %d in %.2fs", error, attempt + 1, delay)
+            time.sleep(delay)
+            attempt += 1
+
+        self.breaker.record_success()
+        result = {"success": True, "text": parse_generation(j), "raw": j}
+        self._cache_put(key, result)
+        return dict(result, cached=False)
+
+    def _budget_exhausted(self, attempt):
+        # the caller's deadline ran out (e.g. while queued on the pool). That says nothing
+        # about the service, so only earlier failed attempts count against the breaker.
+        if attempt == 0:
+            self.breaker.release()
+        else:
+            self.breaker.record_failure()
+
+    def submit(self, prompt, **kwargs):
+        """Run generate() on the bounded worker pool; returns a concurrent.futures.Future."""
+        return self._executor.submit(self.generate, prompt, **kwargs)
+
+    def generate_many(self, prompts, **kwargs):
+        """Generate for several prompts concurrently; failures come back as {'success': False, 'error': ...}."""
+        futures = [self.submit(p, **kwargs) for p in prompts]
+        out = []
+        for f in futures:
+            try:
+                out.append(f.result())
+            except Exception as e:
+                out.append({"success": False, "error": str(e)})
+        return out
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    # shared client so the connection pool, cache and breaker are process-wide
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = CohereClient()
+        return _client
+
 def is_configured():
     return bool(COHERE_KEY)
 
@@ -17,30 +281,4 @@ def analyze_with_cohere(prompt, model="command", max_tokens=256, temperature=0.0
     Send `prompt` to Cohere and return textual result or raise exception.
     Returns a dict: { 'success': True, 'text': '...' } or raises.
     """
-    if not COHERE_KEY:
-        raise RuntimeError("COHERE_API_KEY not set")
-
-    headers = {
-        "Authorization": f"Bearer {COHERE_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-    }
-    r = requests.post(COHERE_URL, headers=headers, json=payload, timeout=30)
-    # Raise for HTTP errors so caller can capture
-    r.raise_for_status()
-    j = r.json()
-    # Cohere returns generated text under choices[0].text or `generations` depending on model/version
-    text = None
-    if "generations" in j and isinstance(j["generations"], list) and j["generations"]:
-        text = j["generations"][0].get("text") or j["generations"][0].get("content")
-    elif "choices" in j and isinstance(j["choices"], list) and j["choices"]:
-        text = j["choices"][0].get("text")
-    else:
-        # fallback: stringify entire body
-        text = str(j)
-    return {"success": True, "text": text, "raw": j}
+    return get_client().generate(prompt, model=model, max_tokens=max_tokens, temperature=temperature)
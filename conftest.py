@@ -0,0 +1,2 @@
+# hf_test.py is an interactive token check (exits without HF_API_KEY), not a test module
+collect_ignore = ["hf_test.py"]
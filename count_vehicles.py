@@ -7,204 +7,679 @@ Outputs: counts.csv (summary) and per_frame_detections.csv (detailed).
 import cv2
 import numpy as np
 import pandas as pd
+import os
 import time
+import argparse
+import multiprocessing
+import csv
+import shutil
+import queue
+import threading
 from tqdm import tqdm
-import torch
 from collections import OrderedDict
 
+# optional: optimal assignment for the tracker (MATCHING = "hungarian")
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
 # --------- Parameters you can tweak ----------
 VIDEO_PATH = "input_video.mp4"   # change to your file
 OUTPUT_CSV = "counts.csv"
 OUTPUT_DET = "per_frame_detections.csv"
 FRAME_SKIP = 2          # process every 2nd frame (speed vs accuracy). For 25 fps -> ~12.5 FPS.
 CONF_THRESH = 0.4
-MAX_DISAPPEARED = 40    # frames before we deregister an object
+MAX_DISAPPEARED = 40    # missed detector runs (at the FRAME_SKIP rate) before we deregister an object; tracked in frames
 MAX_DISTANCE = 60       # max centroid distance to match (in pixels) - tweak by resolution
 COUNT_LINE_POSITION = 0.5  # fraction of frame height where counting line sits (0..1)
+MATCHING = "greedy"     # tracker assignment: "greedy" (fast) or "hungarian" (optimal, needs scipy)
+PIPELINE = False        # decode / batched inference / tracking on separate threads
+BATCH_SIZE = 8          # frames per model call in pipeline mode
+PREFETCH_FRAMES = 32    # bounded queue of decoded frames waiting for inference
+WORKERS = 1             # >1: split videos into segments and process them in a process pool
+SEGMENT_SECONDS = 300   # segment length for sharded mode
+OVERLAP_SECONDS = 4     # tracker warm-up before each segment (frames there are tracked, not counted)
+VIDEO_EXTS = (".mp4", ".avi", ".mov", ".mkv", ".m4v")
+ADAPTIVE = False        # motion-gated frame skipping instead of a fixed FRAME_SKIP
+MOTION_BAND = 0.15      # fraction of frame height checked for motion on each side of the counting line
+MOTION_SCALE = 0.25     # downscale factor for the motion check
+MOTION_PIXEL_DIFF = 25  # grey-level change for a pixel to count as moving
+MOTION_MIN_FRACTION = 0.002  # fraction of moving pixels in the band that counts as motion
+MAX_IDLE_FRAMES = 25    # run the detector at least this often even with no motion (keeps tracks fresh)
+BUSY_TRACKS = 2         # this many tracks inside the band -> detect on every frame
+HISTORY_LEN = 2         # centroids kept per track (the line check only reads the last two)
+DET_FLUSH_ROWS = 5000   # detections buffered before they are appended to OUTPUT_DET (.csv or .parquet)
 CLASSES_TO_COUNT = ["car","motorcycle","bus","truck","bicycle","autorickshaw","van","person"]  # autorickshaw may not be in default model classes
 
 # ------------------------------------------------
 
 # A very simple centroid tracker (keeps minimal state)
 class CentroidTracker:
-    def __init__(self, maxDisappeared=50, maxDistance=50):
+    """
+    Per-object state lives in preallocated NumPy arrays indexed by slot; freed slots
+    are reused and capacity doubles when full, so memory follows the number of live
+    tracks, not the length of the video. History is a fixed-size ring of the last
+    `historyLen` centroids per track.
+
+    update() returns the array of live slots (index centroids, bboxArr, classIdx,
+    countedArr, ... with it) rather than the old (objects, bboxes, classes) dicts.
+    objects / bboxes / classes / counted / disappeared / history are still available
+    as read-only snapshots keyed by objectID; to mark a track counted, set
+    countedArr[slot].
+    """
+    def __init__(self, maxDisappeared=50, maxDistance=50, matching="greedy", historyLen=HISTORY_LEN, capacity=64):
+        if matching not in ("greedy", "hungarian"):
+            raise ValueError(f"unknown matching mode: {matching}")
+        if matching == "hungarian" and linear_sum_assignment is None:
+            raise ImportError("matching='hungarian' requires scipy (pip install scipy)")
         self.nextObjectID = 0
-        self.objects = OrderedDict()   # objectID -> centroid
-        self.bboxes = OrderedDict()    # objectID -> bbox
-        self.classes = OrderedDict()   # objectID -> class_name
-        self.disappeared = OrderedDict()
-        self.counted = OrderedDict()   # objectID -> bool
-        self.history = {}              # objectID -> [centroids]
         self.maxDisappeared = maxDisappeared
         self.maxDistance = maxDistance
+        self.matching = matching
+        self.historyLen = max(2, historyLen)
+        self.classNames = []           # interned class names; classIdx stores indices into this
+        self._classIndex = {}
+        self.slots = OrderedDict()     # objectID -> slot, in registration order
+        self._free = []
+        self.centroids = np.zeros((0, 2), dtype=np.int32)
+        self.bboxArr = np.zeros((0, 4), dtype=np.int32)
+        self.classIdx = np.zeros(0, dtype=np.int32)
+        self.disappearedArr = np.zeros(0, dtype=np.int32)
+        self.countedArr = np.zeros(0, dtype=bool)
+        self.hist = np.zeros((0, self.historyLen, 2), dtype=np.int32)
+        self.histLen = np.zeros(0, dtype=np.int32)
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        old = len(self.centroids)
+        def grown(arr):
+            new = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+            new[:old] = arr
+            return new
+        self.centroids = grown(self.centroids)
+        self.bboxArr = grown(self.bboxArr)
+        self.classIdx = grown(self.classIdx)
+        self.disappearedArr = grown(self.disappearedArr)
+        self.countedArr = grown(self.countedArr)
+        self.hist = grown(self.hist)
+        self.histLen = grown(self.histLen)
+        # pop() hands out the lowest free slot first
+        self._free.extend(range(capacity - 1, old - 1, -1))
+
+    def _class(self, name):
+        idx = self._classIndex.get(name)
+        if idx is None:
+            idx = self._classIndex[name] = len(self.classNames)
+            self.classNames.append(name)
+        return idx
 
     def register(self, centroid, bbox, cls):
-        self.objects[self.nextObjectID] = centroid
-        self.bboxes[self.nextObjectID] = bbox
-        self.classes[self.nextObjectID] = cls
-        self.disappeared[self.nextObjectID] = 0
-        self.counted[self.nextObjectID] = False
-        self.history[self.nextObjectID] = [centroid]
+        if not self._free:
+            self._grow(2 * len(self.centroids))
+        s = self._free.pop()
+        self.centroids[s] = centroid
+        self.bboxArr[s] = bbox
+        self.classIdx[s] = self._class(cls)
+        self.disappearedArr[s] = 0
+        self.countedArr[s] = False
+        self.hist[s, -1] = centroid
+        self.histLen[s] = 1
+        self.slots[self.nextObjectID] = s
         self.nextObjectID += 1
 
     def deregister(self, objectID):
-        del self.objects[objectID]
-        del self.bboxes[objectID]
-        del self.classes[objectID]
-        del self.disappeared[objectID]
-        del self.counted[objectID]
-        del self.history[objectID]
-
-    def update(self, rects, class_names):
-        # rects: list of (startX, startY, endX, endY)
+        self._free.append(self.slots.pop(objectID))
+
+    def active_slots(self):
+        return np.fromiter(self.slots.values(), dtype=np.intp, count=len(self.slots))
+
+    # dict views for callers that want per-object lookups (built on demand)
+    @property
+    def objects(self):
+        return OrderedDict((oid, tuple(self.centroids[s].tolist())) for oid, s in self.slots.items())
+
+    @property
+    def bboxes(self):
+        return OrderedDict((oid, tuple(self.bboxArr[s].tolist())) for oid, s in self.slots.items())
+
+    @property
+    def classes(self):
+        return OrderedDict((oid, self.classNames[self.classIdx[s]]) for oid, s in self.slots.items())
+
+    @property
+    def counted(self):
+        return {oid: bool(self.countedArr[s]) for oid, s in self.slots.items()}
+
+    @property
+    def disappeared(self):
+        return {oid: int(self.disappearedArr[s]) for oid, s in self.slots.items()}
+
+    @property
+    def history(self):
+        return {oid: [tuple(c) for c in self.hist[s, self.historyLen - self.histLen[s]:].tolist()]
+                for oid, s in self.slots.items()}
+
+    def _age(self, objectIDs, slots, elapsed=1):
+        # bump disappeared counters; drop tracks that have been gone too long
+        self.disappearedArr[slots] += elapsed
+        for objectID in np.asarray(objectIDs)[self.disappearedArr[slots] > self.maxDisappeared]:
+            self.deregister(int(objectID))
+
+    def update(self, rects, class_names, elapsed=1):
+        # rects: list or (N,4) array of (startX, startY, endX, endY)
+        # elapsed: time since the previous update, in the units of maxDisappeared (LineCounter uses frames)
         if len(rects) == 0:
             # mark as disappeared
-            for objectID in list(self.disappeared.keys()):
-                self.disappeared[objectID] += 1
-                if self.disappeared[objectID] > self.maxDisappeared:
-                    self.deregister(objectID)
-            return self.objects, self.bboxes, self.classes
-
-        inputCentroids = []
-        for (startX, startY, endX, endY) in rects:
-            cX = int((startX + endX) / 2.0)
-            cY = int((startY + endY) / 2.0)
-            inputCentroids.append((cX, cY))
-
-        if len(self.objects) == 0:
-            for i, centroid in enumerate(inputCentroids):
-                self.register(centroid, rects[i], class_names[i])
+            if self.slots:
+                self._age(list(self.slots.keys()), self.active_slots(), elapsed)
+            return self.active_slots()
+
+        # centroids of all detections in one vectorized step
+        r = np.asarray(rects, dtype="float").reshape(-1, 4)
+        inputArr = ((r[:, :2] + r[:, 2:]) / 2.0).astype(int)
+        boxes = r.astype(int)
+
+        if len(self.slots) == 0:
+            for j in range(len(inputArr)):
+                self.register(inputArr[j], boxes[j], class_names[j])
         else:
-            # compute distance matrix between existing objects and new input centroids
-            objectIDs = list(self.objects.keys())
-            objectCentroids = list(self.objects.values())
-
-            D = np.zeros((len(objectCentroids), len(inputCentroids)), dtype="float")
-            for i, oc in enumerate(objectCentroids):
-                for j, nc in enumerate(inputCentroids):
-                    D[i, j] = np.linalg.norm(np.array(oc) - np.array(nc))
-
-            # greedy matching: find smallest distance pairs
-            rows = D.min(axis=1).argsort()
-            cols = D.argmin(axis=1)[rows]
-
-            assignedRows, assignedCols = set(), set()
-            for (row, col) in zip(rows, cols):
-                if row in assignedRows or col in assignedCols:
-                    continue
-                if D[row, col] > self.maxDistance:
-                    continue
-                objectID = objectIDs[row]
-                # update
-                self.objects[objectID] = inputCentroids[col]
-                self.bboxes[objectID] = rects[col]
-                self.classes[objectID] = class_names[col]
-                self.history[objectID].append(inputCentroids[col])
-                self.disappeared[objectID] = 0
-                assignedRows.add(row)
-                assignedCols.add(col)
+            objectIDs = list(self.slots.keys())
+            slots = self.active_slots()
+
+            # full (objects x detections) distance matrix via broadcasting
+            diff = self.centroids[slots].astype("float")[:, None, :] - inputArr[None, :, :]
+            D = np.sqrt((diff * diff).sum(axis=2))
+
+            pairs = self.match(D)
+            rows = np.array([p[0] for p in pairs], dtype=np.intp)
+            cols = np.array([p[1] for p in pairs], dtype=np.intp)
+            if len(pairs):
+                # update all matched tracks at once; history shifts left by one (ring of historyLen)
+                ms = slots[rows]
+                self.centroids[ms] = inputArr[cols]
+                self.bboxArr[ms] = boxes[cols]
+                self.classIdx[ms] = [self._class(class_names[c]) for c in cols]
+                self.hist[ms, :-1] = self.hist[ms, 1:]
+                self.hist[ms, -1] = inputArr[cols]
+                self.histLen[ms] = np.minimum(self.histLen[ms] + 1, self.historyLen)
+                self.disappearedArr[ms] = 0
 
             # any unassigned objectIDs -> disappeared
-            for i, objectID in enumerate(objectIDs):
-                if i not in assignedRows:
-                    self.disappeared[objectID] += 1
-                    if self.disappeared[objectID] > self.maxDisappeared:
-                        self.deregister(objectID)
+            unmatched = np.ones(len(slots), dtype=bool)
+            unmatched[rows] = False
+            if unmatched.any():
+                self._age(np.asarray(objectIDs)[unmatched], slots[unmatched], elapsed)
 
             # any unassigned inputCentroids -> register new object
-            for j, centroid in enumerate(inputCentroids):
+            assignedCols = set(cols.tolist())
+            for j in range(len(inputArr)):
                 if j not in assignedCols:
-                    self.register(centroid, rects[j], class_names[j])
-
-        return self.objects, self.bboxes, self.classes
+                    self.register(inputArr[j], boxes[j], class_names[j])
+
+        return self.active_slots()
+
+    def match(self, D):
+        """Return (row, col) pairs from distance matrix D, all within maxDistance."""
+        if self.matching == "hungarian":
+            # pairs beyond maxDistance get a prohibitive cost so they never shape the solution
+            cost = np.where(D > self.maxDistance, 1e9, D)
+            rows, cols = linear_sum_assignment(cost)
+            return [(r, c) for r, c in zip(rows, cols) if D[r, c] <= self.maxDistance]
+
+        # greedy matching: find smallest distance pairs
+        rows = D.min(axis=1).argsort()
+        cols = D.argmin(axis=1)[rows]
+        pairs = []
+        usedRows, usedCols = set(), set()
+        for (row, col) in zip(rows, cols):
+            if row in usedRows or col in usedCols:
+                continue
+            if D[row, col] > self.maxDistance:
+                continue
+            usedRows.add(row)
+            usedCols.add(col)
+            pairs.append((row, col))
+        return pairs
 
 # -----------------------
 # Main processing
 # -----------------------
-def main():
-    # load YOLOv5 via torch.hub
+def load_model():
+    # load YOLOv5 via torch.hub (imported here so the tracker can be used without torch)
+    import torch
     print("Loading model (this may download weights first time)...")
     model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
     model.conf = CONF_THRESH
-
-    cap = cv2.VideoCapture(VIDEO_PATH)
-    if not cap.isOpened():
-        print("Error opening video:", VIDEO_PATH)
+    return model
+
+class DetectionWriter:
+    """
+    Streams per-detection rows to a CSV (or Parquet, if the path ends in .parquet
+    and pyarrow is installed) in chunks of `flush_rows`, so memory stays flat and
+    everything up to the last flush survives an interrupted run.
+
+    A Parquet file is only readable once its footer is written, so Parquet output is
+    a dataset directory with one complete part-NNNNNN.parquet file per flush
+    (read it back with pd.read_parquet(path) or pyarrow.dataset).
+    """
+    COLUMNS = ["frame", "x1", "y1", "x2", "y2", "conf", "class"]
+
+    def __init__(self, path, video_column=False, flush_rows=DET_FLUSH_ROWS, on_flush=None):
+        self.path = path
+        self.columns = self.COLUMNS + (["video"] if video_column else [])
+        self.flush_rows = flush_rows
+        self.on_flush = on_flush
+        self.rows = 0
+        self._buf = []
+        self.parquet = path.lower().endswith(".parquet")
+        if self.parquet:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Parquet output requires pyarrow (pip install pyarrow)")
+            self._pa, self._pq = pa, pq
+            types = {"conf": pa.float64(), "class": pa.string(), "video": pa.string()}
+            self._schema = pa.schema([(c, types.get(c, pa.int64())) for c in self.columns])
+            self._chunks = 0
+            self._fh = None
+            # start from an empty dataset directory (drop a stale file or old parts)
+            if os.path.isfile(path):
+                os.remove(path)
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.startswith("part-") and name.endswith(".parquet"):
+                    os.remove(os.path.join(path, name))
+        else:
+            self._fh = open(path, "w", newline="")
+            self._csv = csv.writer(self._fh)
+            self._csv.writerow(self.columns)
+            self._fh.flush()
+
+    def add(self, row):
+        # row: tuple in self.columns order
+        self._buf.append(row)
+        if len(self._buf) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            if self.parquet:
+                cols = list(zip(*self._buf))
+                table = self._pa.table({c: list(v) for c, v in zip(self.columns, cols)}, schema=self._schema)
+                self._write_chunk(table)
+            else:
+                self._csv.writerows(self._buf)
+                self._fh.flush()
+            self.rows += len(self._buf)
+            self._buf = []
+        if self.on_flush:
+            self.on_flush()
+
+    def _write_chunk(self, table):
+        # write to a hidden temp name and rename, so a part file is either complete or absent
+        name = f"part-{self._chunks:06d}.parquet"
+        tmp = os.path.join(self.path, "." + name + ".tmp")
+        self._pq.write_table(table, tmp)
+        os.replace(tmp, os.path.join(self.path, name))
+        self._chunks += 1
+
+    def close(self):
+        self.flush()
+        if self.parquet:
+            if self._chunks == 0:
+                # no detections at all: still leave an (empty) part so the schema is known
+                self._write_chunk(self._schema.empty_table())
+        elif self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def merge_detection_parts(parts, path):
+    # concatenate per-segment part outputs (same format as `path`) in order, then delete them
+    if path.lower().endswith(".parquet"):
+        # parts are dataset directories: move their chunk files over, renumbered in order
+        if os.path.isfile(path):
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+        n = 0
+        for part in parts:
+            for name in sorted(os.listdir(part)):
+                if name.startswith("part-") and name.endswith(".parquet"):
+                    os.replace(os.path.join(part, name), os.path.join(path, f"part-{n:06d}.parquet"))
+                    n += 1
+            shutil.rmtree(part)
         return
+    with open(path, "w", newline="") as out:
+        for i, part in enumerate(parts):
+            with open(part, newline="") as fh:
+                header = fh.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(fh, out)
+    for part in parts:
+        os.remove(part)
+
+class LineCounter:
+    """
+    Tracker + counting-line state; consume() is fed detections in frame order.
+    Frames up to `count_from` only warm up the tracker: their detections are not
+    recorded and their crossings are not counted (they belong to the previous segment).
+    Detections go to `sink` (a DetectionWriter) as they arrive.
+    """
+    def __init__(self, line_y, count_from=0, sink=None, video=None):
+        self.line_y = line_y
+        self.count_from = count_from
+        self.sink = sink
+        self.video = video
+        # disappearance is counted in frames so expiry takes the same time whatever the gate does
+        self.tracker = CentroidTracker(maxDisappeared=MAX_DISAPPEARED * FRAME_SKIP, maxDistance=MAX_DISTANCE,
+                                       matching=MATCHING)
+        self.counts = {}         # class -> count
+        self.near_line = 0       # tracks inside the motion band after the last update (read by AdaptiveScheduler)
+        self.band_px = 0
+        self.frames_inferred = 0
+        self.last_frame = None
+
+    def consume(self, frame_idx, det, names):
+        # det: (N,6) array of x1,y1,x2,y2,conf,cls for one frame
+        self.frames_inferred += 1
+        # age tracks by frames elapsed: FRAME_SKIP per call with the fixed gate, 1 in busy
+        # mode, more after adaptive idle gaps, so stale tracks expire after the same time
+        if self.last_frame is None:
+            elapsed = FRAME_SKIP
+        else:
+            elapsed = max(1, frame_idx - self.last_frame)
+        self.last_frame = frame_idx
+        owned = frame_idx > self.count_from
+        det = np.asarray(det).reshape(-1, 6)
+        # we keep every class here; only CLASSES_TO_COUNT are kept when summarizing
+        class_names = [names[int(c)] for c in det[:, 5]]
+        boxes = det[:, :4].astype(int)
+
+        if owned and self.sink is not None:
+            extra = (self.video,) if self.video is not None else ()
+            for (x1, y1, x2, y2), conf, name in zip(boxes.tolist(), det[:, 4].tolist(), class_names):
+                self.sink.add((frame_idx, x1, y1, x2, y2, float(conf), name) + extra)
 
-    W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    print(f"Video: {W}x{H} @ {fps}fps, frames={total_frames}")
-
-    line_y = int(H * COUNT_LINE_POSITION)
-
-    tracker = CentroidTracker(maxDisappeared=MAX_DISAPPEARED, maxDistance=MAX_DISTANCE)
-    counts = {}  # class -> count
-    frame_records = []  # detailed per-frame record
-
+        # update tracker
+        tracker = self.tracker
+        slots = tracker.update(boxes, class_names, elapsed=elapsed)
+        if len(slots) == 0:
+            self.near_line = 0
+            return
+
+        # check crossing line for every tracked object at once (downward crossings)
+        line_y = self.line_y
+        prev_y = tracker.hist[slots, -2, 1]
+        cur_y = tracker.hist[slots, -1, 1]
+        crossing = (tracker.histLen[slots] >= 2) & (prev_y < line_y) & (cur_y >= line_y) & ~tracker.countedArr[slots]
+        # (to count upward crossings too, add: (prev_y > line_y) & (cur_y <= line_y))
+        for s in slots[crossing]:
+            if owned:
+                cls = tracker.classNames[tracker.classIdx[s]]
+                self.counts[cls] = self.counts.get(cls, 0) + 1
+            tracker.countedArr[s] = True
+
+        if self.band_px:
+            self.near_line = int((np.abs(tracker.centroids[slots, 1] - line_y) <= self.band_px).sum())
+
+class AdaptiveScheduler:
+    """
+    Decides per frame whether to run the detector. A cheap frame difference over a
+    downscaled band around the counting line gates inference:
+      - several tracks inside the band -> every frame (crossings are imminent)
+      - motion in the band             -> every FRAME_SKIP frames (the fixed baseline)
+      - no motion                      -> only every MAX_IDLE_FRAMES frames
+    """
+    def __init__(self, counter, frame_height):
+        self.counter = counter
+        self.line_y = counter.line_y
+        self.band_px = int(frame_height * MOTION_BAND)
+        counter.band_px = self.band_px
+        self.prev = None
+        self.last_detect = None
+        self.motion_frames = 0
+
+    def motion(self, frame):
+        top = max(0, self.line_y - self.band_px)
+        band = frame[top:self.line_y + self.band_px]
+        small = cv2.resize(band, None, fx=MOTION_SCALE, fy=MOTION_SCALE, interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        prev, self.prev = self.prev, gray
+        if prev is None or prev.shape != gray.shape:
+            return True
+        moving = cv2.absdiff(gray, prev) > MOTION_PIXEL_DIFF
+        return moving.mean() >= MOTION_MIN_FRACTION
+
+    def should_detect(self, frame_idx, frame):
+        moving = self.motion(frame)
+        if moving:
+            self.motion_frames += 1
+        if self.last_detect is None:
+            step = 1
+        elif self.counter.near_line >= BUSY_TRACKS:
+            step = 1
+        elif moving:
+            step = FRAME_SKIP
+        else:
+            step = MAX_IDLE_FRAMES
+        if self.last_detect is None or frame_idx - self.last_detect >= step:
+            self.last_detect = frame_idx
+            return True
+        return False
+
+def make_gate(counter, frame_height, adaptive):
+    # returns should_detect(frame_idx, frame)
+    if adaptive:
+        return AdaptiveScheduler(counter, frame_height).should_detect
+    return lambda frame_idx, frame: frame_idx % FRAME_SKIP == 0
+
+def run_serial(cap, model, counter, pbar, start=0, stop=None, gate=None):
+    # frame_idx is 1-based; `start`/`stop` are 0-based frame positions (stop exclusive)
+    gate = gate or make_gate(counter, 0, False)
     frame_idx = 0
-    pbar = tqdm(total=total_frames//FRAME_SKIP + 1)
-
-    while True:
+    if start:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        # seeking can land on an earlier keyframe: take the real position and step forward,
+        # so frame_idx (and with it the count_from ownership boundary) stays exact
+        frame_idx = max(0, int(cap.get(cv2.CAP_PROP_POS_FRAMES)))
+        while frame_idx < start and cap.grab():
+            frame_idx += 1
+    while stop is None or frame_idx < stop:
         ret, frame = cap.read()
         if not ret:
             break
         frame_idx += 1
-        if frame_idx % FRAME_SKIP != 0:
+        if not gate(frame_idx, frame):
             continue
 
         # run detection
         results = model(frame)            # results is a yolov5 Results object
         det = results.xyxy[0].cpu().numpy()  # (N,6): x1,y1,x2,y2,conf,cls
-
-        rects = []
-        class_names = []
-        for *xyxy, conf, cls in det:
-            cls = int(cls)
-            name = results.names[cls]
-            # basic filter - keep vehicle related classes; adapt as needed
-            if name not in ["car","motorcycle","bus","truck","bicycle","person","train","boat","truck","bus","traffic light","truck"]:
-                # still allow unknown classes; but we'll only count classes in CLASSES_TO_COUNT when summarizing
+        counter.consume(frame_idx, det, results.names)
+        pbar.update(1)
+    return frame_idx
+
+def run_pipelined(cap, model, counter, pbar, batch_size=BATCH_SIZE, prefetch=PREFETCH_FRAMES, gate=None):
+    """
+    Three stages connected by bounded queues:
+    decoder thread -> batched inference (this thread) -> tracking/counting thread.
+    Batches are submitted in order and the consumer is single-threaded, so the
+    tracker still sees frames in frame order. With an adaptive gate the decoder reads
+    the counter's near-line count from the previous completed batch. On an error or
+    Ctrl-C in any stage, `stop` tells the decoder to quit instead of reading to EOF.
+    """
+    gate = gate or make_gate(counter, 0, False)
+    frames_q = queue.Queue(maxsize=prefetch)
+    results_q = queue.Queue(maxsize=prefetch)
+    errors = []
+    decoded = [0]
+    stop = threading.Event()
+
+    def decode():
+        try:
+            frame_idx = 0
+            while not stop.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame_idx += 1
+                if not gate(frame_idx, frame):
+                    continue
+                frames_q.put((frame_idx, frame))
+            decoded[0] = frame_idx
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frames_q.put(None)
+
+    def track():
+        try:
+            while True:
+                item = results_q.get()
+                if item is None:
+                    break
+                frame_idx, det, names = item
+                counter.consume(frame_idx, det, names)
+                pbar.update(1)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            # keep draining so the inference stage never blocks on a full queue
+            while results_q.get() is not None:
                 pass
-            x1, y1, x2, y2 = map(int, xyxy)
-            rects.append((x1,y1,x2,y2))
-            class_names.append(name)
-
-            # record per-detection
-            frame_records.append({
-                "frame": frame_idx,
-                "x1": x1, "y1": y1, "x2": x2, "y2": y2,
-                "conf": float(conf),
-                "class": name
-            })
 
-        # update tracker
-        objects, bboxes, classes = tracker.update(rects, class_names)
+    decoder = threading.Thread(target=decode, name="decoder", daemon=True)
+    consumer = threading.Thread(target=track, name="tracker", daemon=True)
+    decoder.start()
+    consumer.start()
+    try:
+        done = False
+        while not done and not stop.is_set():
+            batch = []
+            while len(batch) < batch_size:
+                item = frames_q.get()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if not batch or stop.is_set():
+                break
+            results = model([f for _, f in batch])
+            for (frame_idx, _), det in zip(batch, results.xyxy):
+                results_q.put((frame_idx, det.cpu().numpy(), results.names))
+    finally:
+        results_q.put(None)
+        if not done:
+            # stop the decoder, then unblock it if it is waiting on a full queue
+            stop.set()
+            while decoder.is_alive():
+                try:
+                    frames_q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        decoder.join()
+        consumer.join()
+    if errors:
+        raise errors[0]
+    return decoded[0]
 
-        # check crossing line for each tracked object
-        for objectID, centroid in objects.items():
-            hist = tracker.history[objectID]
-            if len(hist) < 2:
-                continue
-            prev_y = hist[-2][1]
-            cur_y = hist[-1][1]
-            cls = tracker.classes[objectID]
-            # crossing downward
-            if (prev_y < line_y) and (cur_y >= line_y) and (not tracker.counted[objectID]):
-                counts[cls] = counts.get(cls, 0) + 1
-                tracker.counted[objectID] = True
-            # crossing upward (if you want to count both directions, handle similarly)
-            # elif (prev_y > line_y) and (cur_y <= line_y) and (not tracker.counted[objectID]):
-            #     counts[cls] = counts.get(cls, 0) + 1
-            #     tracker.counted[objectID] = True
-
-        pbar.update(1)
-
-    pbar.close()
+# -----------------------
+# Sharded (multi-process) processing
+# -----------------------
+_worker_model = None
+
+def _init_worker(threads):
+    global _worker_model
+    import torch
+    # one model per worker; split the cores between workers instead of oversubscribing
+    torch.set_num_threads(threads)
+    _worker_model = load_model()
+
+def list_videos(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(VIDEO_EXTS))
+    return [path]
+
+def plan_segments(videos, segment_seconds, overlap_seconds):
+    """
+    Split each video into [start, stop) frame ranges. Each job starts `overlap`
+    frames early so its tracker is warm when its own range begins; a crossing is
+    only counted by the segment that owns the frame it happens on.
+    """
+    jobs = []
+    for vi, path in enumerate(videos):
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            print("Error opening video:", path)
+            continue
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        seg = max(1, int(segment_seconds * fps))
+        overlap = int(overlap_seconds * fps)
+        if total <= 0:
+            jobs.append({"vi": vi, "path": path, "start": 0, "stop": None, "warm_start": 0})
+            continue
+        for start in range(0, total, seg):
+            stop = min(total, start + seg)
+            # the last segment reads to EOF in case the frame count was underestimated
+            jobs.append({"vi": vi, "path": path, "start": start, "stop": None if stop == total else stop,
+                         "warm_start": max(0, start - overlap)})
+    return jobs
+
+def process_segment(job):
+    start = job["start"]
+    cap = cv2.VideoCapture(job["path"])
+    H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    # each segment streams its detections to its own part file, merged afterwards
+    with DetectionWriter(job["part"], video_column=job["video"] is not None) as sink:
+        counter = LineCounter(int(H * COUNT_LINE_POSITION), count_from=start, sink=sink, video=job["video"])
+        gate = make_gate(counter, H, job["adaptive"])
+        # run_serial corrects keyframe-approximate seeks, so frame indices (and ownership) are exact
+        frames_read = run_serial(cap, _worker_model, counter, tqdm(disable=True),
+                                 start=job["warm_start"], stop=job["stop"], gate=gate)
     cap.release()
-
+    return job["vi"], start, counter.counts, job["part"], frames_read - start
+
+def run_sharded(videos, workers, segment_seconds, overlap_seconds, adaptive=False):
+    global _worker_model
+    jobs = plan_segments(videos, segment_seconds, overlap_seconds)
+    base, ext = os.path.splitext(OUTPUT_DET)
+    for job in jobs:
+        job["adaptive"] = adaptive
+        job["video"] = os.path.basename(job["path"]) if len(videos) > 1 else None
+        job["part"] = f"{base}.part-{job['vi']:03d}-{job['start']:09d}{ext}"
+    print(f"{len(videos)} video(s) -> {len(jobs)} segment(s) on {workers} worker(s)")
+    if workers <= 1:
+        if _worker_model is None:
+            _worker_model = load_model()
+        results = [process_segment(j) for j in tqdm(jobs)]
+    else:
+        threads = max(1, (os.cpu_count() or workers) // workers)
+        # spawn: torch and OpenCV are not fork-safe once initialised
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(threads,)) as pool:
+            results = list(tqdm(pool.imap_unordered(process_segment, jobs), total=len(jobs)))
+
+    # stitch: segments are merged in (video, start) order so detections stay in frame order
+    counts, parts, frames_read = {}, [], 0
+    for vi, start, seg_counts, part, seg_frames in sorted(results, key=lambda r: (r[0], r[1])):
+        for cls, c in seg_counts.items():
+            counts[cls] = counts.get(cls, 0) + c
+        parts.append(part)
+        frames_read += seg_frames
+    merge_detection_parts(parts, OUTPUT_DET)
+    return counts, frames_read
+
+def write_counts(counts, quiet=False):
     # Summarize: only keep desired classes (you can modify)
     summary = []
     for cls, c in counts.items():
@@ -216,10 +691,80 @@ def main():
             summary.append({"class": cls, "count": 0})
 
     df = pd.DataFrame(summary).sort_values(by="class")
-    df.to_csv(OUTPUT_CSV, index=False)
-    pd.DataFrame(frame_records).to_csv(OUTPUT_DET, index=False)
-    print("Done. Summary written to", OUTPUT_CSV)
-    print(df)
+    # write-then-rename so a crash never leaves a truncated summary
+    tmp = OUTPUT_CSV + ".tmp"
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, OUTPUT_CSV)
+    if not quiet:
+        print("Done. Summary written to", OUTPUT_CSV, "and detections to", OUTPUT_DET)
+        print(df)
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Count vehicles crossing a line in a video.")
+    ap.add_argument("--video", default=VIDEO_PATH, help="input video file, or a directory of videos")
+    ap.add_argument("--pipeline", action="store_true", default=PIPELINE,
+                    help="prefetch frames on a decoder thread and run batched inference")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="frames per model call (pipeline mode)")
+    ap.add_argument("--prefetch", type=int, default=PREFETCH_FRAMES, help="decoded-frame queue size (pipeline mode)")
+    ap.add_argument("--adaptive", action="store_true", default=ADAPTIVE,
+                    help="motion-gated frame skipping around the counting line instead of a fixed FRAME_SKIP")
+    ap.add_argument("--workers", type=int, default=WORKERS, help="processes for sharded mode (one model each)")
+    ap.add_argument("--segment-seconds", type=float, default=SEGMENT_SECONDS, help="segment length for sharded mode")
+    ap.add_argument("--overlap-seconds", type=float, default=OVERLAP_SECONDS, help="tracker warm-up before each segment")
+    return ap.parse_args()
+
+def main():
+    args = parse_args()
+    if args.workers > 1 or os.path.isdir(args.video):
+        videos = list_videos(args.video)
+        if not videos:
+            print("No videos found:", args.video)
+            return
+        t0 = time.perf_counter()
+        counts, frames_read = run_sharded(videos, args.workers, args.segment_seconds, args.overlap_seconds,
+                                          adaptive=args.adaptive)
+        elapsed = time.perf_counter() - t0
+        print(f"Processed {frames_read} frames in {elapsed:.1f}s -> {frames_read / max(elapsed, 1e-9):.1f} video FPS")
+        write_counts(counts)
+        return
+
+    model = load_model()
+
+    cap = cv2.VideoCapture(args.video)
+    if not cap.isOpened():
+        print("Error opening video:", args.video)
+        return
+
+    W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    print(f"Video: {W}x{H} @ {fps}fps, frames={total_frames}")
+
+    # detections are streamed to OUTPUT_DET; counts.csv is checkpointed on every flush
+    sink = DetectionWriter(OUTPUT_DET)
+    counter = LineCounter(int(H * COUNT_LINE_POSITION), sink=sink)
+    sink.on_flush = lambda: write_counts(counter.counts, quiet=True)
+    gate = make_gate(counter, H, args.adaptive)
+    pbar = tqdm(total=total_frames//FRAME_SKIP + 1)
+
+    t0 = time.perf_counter()
+    try:
+        if args.pipeline:
+            frames_read = run_pipelined(cap, model, counter, pbar, batch_size=args.batch_size, prefetch=args.prefetch,
+                                        gate=gate)
+        else:
+            frames_read = run_serial(cap, model, counter, pbar, gate=gate)
+    finally:
+        sink.close()
+    elapsed = time.perf_counter() - t0
+
+    pbar.close()
+    cap.release()
+
+    print(f"Processed {frames_read} frames ({counter.frames_inferred} inferred) in {elapsed:.1f}s "
+          f"-> {frames_read / max(elapsed, 1e-9):.1f} video FPS, {counter.frames_inferred / max(elapsed, 1e-9):.1f} inference FPS")
+    write_counts(counter.counts)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,125 @@
+# test_cohere_client.py -- cohere_client against a local stub HTTP server (no API key or network needed)
+# Usage: python -m pytest test_cohere_client.py   (or: python -m unittest test_cohere_client)
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# keep the backend's SQLite file out of the working tree
+os.environ.setdefault("WAM_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="wam-test-"), "data.db"))
+
+import cohere_client
+import backend
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            status, delay = server.script.pop(0) if server.script else (200, 0)
+        time.sleep(delay)
+        if status < 400:
+            out = json.dumps({"generations": [{"text": "stub: " + body["prompt"]}]}).encode()
+        else:
+            out = b'{"message": "unavailable"}'
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.script = []  # (status, delay) per request, then 200s
+
+    def handle_error(self, request, client_address):
+        pass  # the client hung up after its timeout
+
+class CohereClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1/generate"
+        patcher = mock.patch.object(cohere_client, "BACKOFF_BASE", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        c = cohere_client.CohereClient(api_key="test", url=self.url, cache_dir="", **kwargs)
+        self.addCleanup(c.close)
+        return c
+
+    def test_retries_on_503(self):
+        self.server.script = [(503, 0), (503, 0)]
+        result = self.client().generate("hello")
+        self.assertEqual(result["text"], "stub: hello")
+        self.assertEqual(self.server.calls, 3)
+
+    def test_cache_hit(self):
+        c = self.client()
+        self.assertFalse(c.generate("hello")["cached"])
+        again = c.generate("hello")
+        self.assertTrue(again["cached"])
+        self.assertEqual(again["text"], "stub: hello")
+        self.assertEqual(self.server.calls, 1)
+
+    def test_breaker_open_half_open_closed(self):
+        breaker = cohere_client.CircuitBreaker(failures=2, cooldown=0.2)
+        c = self.client(breaker=breaker, max_retries=0)
+        self.server.script = [(503, 0), (503, 0)]
+        for prompt in ("a", "b"):
+            with self.assertRaises(cohere_client.requests.HTTPError):
+                c.generate(prompt)
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(cohere_client.CircuitOpenError):
+            c.generate("c")
+        self.assertEqual(self.server.calls, 2)
+        time.sleep(0.25)
+        self.assertEqual(breaker.state, "half-open")
+        self.assertEqual(c.generate("d")["text"], "stub: d")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_enrich_falls_back_when_over_budget(self):
+        c = self.client()
+        self.server.script = [(200, 1.0)]
+        resp_json = {"type": "local", "generated_text": "local summary"}
+        with mock.patch.object(cohere_client, "get_client", return_value=c), \
+             mock.patch.object(backend, "ANALYZE_LLM_BUDGET", 0.2):
+            started = time.monotonic()
+            with backend.app.app_context():
+                llm = backend.enrich_with_llm(resp_json, {})
+            elapsed = time.monotonic() - started
+        self.assertFalse(llm["used"])
+        self.assertEqual(resp_json["generated_text"], "local summary")
+        self.assertLess(elapsed, 0.8)
+        # a late answer is abandoned, so it doesn't count against the breaker either
+        self.assertEqual(c.breaker.failures, 0)
+
+        with mock.patch.object(cohere_client, "get_client", return_value=c), \
+             mock.patch.object(backend, "ANALYZE_LLM_BUDGET", 2.0):
+            with backend.app.app_context():
+                llm = backend.enrich_with_llm(resp_json, {"inputs": "Summarize."})
+        self.assertTrue(llm["used"])
+        self.assertEqual(resp_json["type"], "cohere")
+        self.assertEqual(resp_json["local_text"], "local summary")
+
+if __name__ == "__main__":
+    unittest.main()